@@ -1,16 +1,20 @@
 import datetime
 import os.path
 import logging
-import json
-import requests
+import orjson
+import aiohttp
+import atexit
 import discord
-import ffmpeg
 import shutil
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from queue import SimpleQueue
 from discord.ext import tasks
 from instagrapi import Client as IGClient
 from modules import Config, Media
 from PIL import Image
-from io import BytesIO
 
 import asyncio
 
@@ -18,27 +22,77 @@ cf = Config().load()
 cfg_discord = cf['discord']
 cfg_instagram = cf['instagram']
 
-logging.basicConfig(filename=f"logs/{datetime.datetime.now().strftime("%Y-%m-%d_T%H-%M-%S")}.log", filemode="w", format="%(asctime)s %(levelname)s %(message)s", level=logging.DEBUG)
-# logging.getLogger().addHandler(logging.StreamHandler())
+# submission state -> reaction on the submit message
+ReactionConfig = {
+    "queued" : '🕒',
+    "invalid" : '❌',
+    "uploaded" : '✅'
+}
+
+# read on every incoming message, resolve once. ids may be written as strings in config.json
+GUILD_ID = int(cfg_discord['guild_id'])
+SUBMIT_CHANNEL_ID = int(cfg_discord['submit_channel_id'])
+QUEUE_CHANNEL_ID = int(cfg_discord['queue_channel_id'])
+
+# instagram.hwaccel -> (ffmpeg decode args, h264 encoder)
+HWAccelConfig = {
+    "cuda" : (['-hwaccel', 'cuda'], 'h264_nvenc'),
+    "qsv" : (['-hwaccel', 'qsv'], 'h264_qsv'),
+    "videotoolbox" : (['-hwaccel', 'videotoolbox'], 'h264_videotoolbox'),
+    "vaapi" : (['-hwaccel', 'vaapi', '-hwaccel_output_format', 'vaapi'], 'h264_vaapi')
+}
+# "auto" picks the first working one in this order. vaapi needs frames uploaded to a device, it's opt-in only
+HWAccelAutoOrder = ('cuda', 'qsv', 'videotoolbox')
+
+def setup_logging() :
+    # records are handed to a background thread, the event loop never blocks on the log file
+    log_handler = RotatingFileHandler(f"logs/{datetime.datetime.now().strftime("%Y-%m-%d_T%H-%M-%S")}.log", maxBytes=10_000_000, backupCount=3, delay=True)
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log_queue = SimpleQueue()
+    log_listener = QueueListener(log_queue, log_handler)
+    logging.basicConfig(handlers=[QueueHandler(log_queue)], level=logging.INFO)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    # logging.getLogger().addHandler(logging.StreamHandler())
 
 class QueueManager : 
-    def __init__(self) :
+    # compact list.log into list.json once this many records are pending
+    COMPACT_EVERY = 100
+    instance = None
+
+    def __new__(cls) :
+        # one queue per process, later QueueManager() calls reuse the loaded queue
+        if cls.instance is None :
+            cls.instance = super().__new__(cls)
+            cls.instance.load()
+        return cls.instance
+
+    def load(self) :
         logging.info("[queuemanager] init")
-        self.queue = []
-        if os.path.isdir('_queue') == False:
-            logging.info("[queuemanager] '_queue' folder does not exist. create new")
-            os.makedirs('_queue')
-
-        if os.path.isdir('_queue/media') == False :
-            logging.info("[queuemanager] '_queue/media' folder does not exist. create new")
-            os.makedirs('_queue/media')
+        self.queue = OrderedDict()
+        self.ops = 0
+        os.makedirs('_queue/media', exist_ok=True)
+
+        self.clean_media()
         
         try :
-            with open('_queue/list.json') as f :
+            with open('_queue/list.json', 'rb') as f :
                 logging.info("[queuemanager] load file")
-                self.queue = json.load(f)
+                self.queue = OrderedDict((d["id"], d) for d in orjson.loads(f.read()))
         except :
             logging.error(f"[queuemanager] invalid list.json. set queue as empty")
+
+        replayed = 0
+        if os.path.isfile('_queue/list.log') :
+            with open('_queue/list.log', 'rb') as f :
+                logging.info("[queuemanager] replay log")
+                replayed = self.replay(f)
+
+        self.log = open('_queue/list.log', 'ab', buffering=0)
+        if replayed :
+            # fold the replayed records in now: the log can't grow across crash loops, and new
+            # appends never land on a torn last line
+            self.save()
         
 
     def load_information(self) -> None :
@@ -50,96 +104,283 @@ class QueueManager :
         return len(self.queue)
         
     def add(self, data) :
-        logging.info("[queuemanager] add queue")
-        self.queue.append(data)
-        self.save()
+        logging.debug("[queuemanager] add queue")
+        self.queue[data["id"]] = data
+        self.append({"op" : "add", "data" : data})
 
     def get_first(self, pop = False) :
+        if len(self.queue) == 0 :
+            return None
+
         output = []
         if pop :
-            output = self.queue.pop(0)
-            logging.info(f"[queuemanager] get first with pop. data = {output}")
-            self.save()
+            _, output = self.queue.popitem(last=False)
+            logging.debug("[queuemanager] get first with pop. data = %s", output)
+            self.append({"op" : "pop", "id" : output["id"]})
         else :
-            output = self.queue[0]
-            logging.info(f"[queuemanager] get first without pop. data = {output}")
+            output = next(iter(self.queue.values()))
+            logging.debug("[queuemanager] get first without pop. data = %s", output)
 
         return output
 
     def raw(self) : 
-        logging.info(f"[queuemanager] output raw. data = {self.queue}")
-        return self.queue
+        output = list(self.queue.values())
+        logging.debug("[queuemanager] output raw. data = %s", output)
+        return output
     
     def remove_by_id(self, message) :
-        logging.info("[queuemanager] remove queue by id")
-        self.queue = [d for d in self.queue if d["id"] != message.message_id]
-        self.save()
-        
+        logging.debug("[queuemanager] remove queue by id")
+        if self.queue.pop(message.message_id, None) is not None :
+            self.append({"op" : "pop", "id" : message.message_id})
+
+    def clean_media(self, max_age = 1800) :
+        # leftovers from uploads interrupted by a crash or restart
+        now = time.time()
+        with os.scandir('_queue/media') as entries :
+            for entry in entries :
+                if entry.is_dir() and now - entry.stat().st_mtime > max_age :
+                    logging.info(f"[queuemanager] remove stale media folder {entry.name}")
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+    def replay(self, f) :
+        # records already folded into list.json (crash before truncate) are skipped
+        count = 0
+        for line in f :
+            count += 1
+            try :
+                record = orjson.loads(line)
+            except ValueError :
+                logging.error(f"[queuemanager] invalid list.log record. skip")
+                continue
+
+            if record["op"] == "add" :
+                self.queue.setdefault(record["data"]["id"], record["data"])
+            elif record["op"] == "pop" :
+                self.queue.pop(record["id"], None)
+
+        return count
+
+    def append(self, record) :
+        self.log.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+        self.ops += 1
+
+    def flush(self) :
+        # compaction is write-behind, mutations only ever pay for the log append
+        if self.ops >= self.COMPACT_EVERY :
+            self.save()
+
     def save(self):
-        with open('_queue/list.json', 'w') as f :
-            logging.info("[queuemanager] save queue")
-            json.dump(self.queue, f)
+        # write then rename, a crash mid-save never leaves a truncated list.json
+        with open('_queue/list.json.tmp', 'wb') as f :
+            logging.debug("[queuemanager] save queue")
+            f.write(orjson.dumps(list(self.queue.values())))
+            # the log is truncated right after, the snapshot has to be on disk before the rename is
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace('_queue/list.json.tmp', '_queue/list.json')
+
+        self.log.close()
+        self.log = open('_queue/list.log', 'wb', buffering=0)
+        self.ops = 0
+
+    def close(self) :
+        logging.info("[queuemanager] close")
+        self.save()
+        self.log.close()
 
-class InstagramClient(IGClient) :
-    def __init__(self) -> None:
+class InstagramClient :
+    def __init__(self, session) -> None:
+        self.session = session
         self.client = IGClient()
         if os.path.isfile('session.json'):
             self.client.load_settings('session.json')
         else :
             self.client.login(cfg_instagram['username'], cfg_instagram['password'])
             self.client.dump_settings('session.json')
-    pass
 
-    def upload_queue(self) :
-        queue = QueueManager()
+        # bounds concurrent downloads per queue item
+        self.media_sem = asyncio.Semaphore(cfg_instagram.get('concurrency', 4))
+        # bounds concurrent ffmpeg processes, cpu_count // 2 processes at -threads 2 fill the cores without oversubscribing
+        self.transcode_sem = asyncio.Semaphore(max(1, (os.cpu_count() or 2) // 2))
+        # hardware encoders cap sessions per gpu (consumer nvenc allows only a few), bounded apart from the cpu pool
+        self.hwaccel_sem = asyncio.Semaphore(cfg_instagram.get('hwaccel_concurrency', 2))
+        self.upload_lock = asyncio.Lock()
+        self.hwaccel = cfg_instagram.get('hwaccel', '')
+        # "auto" is resolved once, concurrent videos wait for the first probe
+        self.hwaccel_lock = asyncio.Lock()
+
+    def convert_photo(self, src, dst) :
+        with Image.open(src) as image :
+            # RGB jpeg can be uploaded as is, skip the decode / re-encode
+            if image.format == 'JPEG' and image.mode == 'RGB' :
+                passthrough = True
+            else :
+                passthrough = False
+                # jpeg only: let libjpeg downscale while decoding (DCT scaling), instagram serves at most 1080px.
+                # cmyk / greyscale sources keep their mode here, convert() below still does the colour conversion
+                image.draft('RGB', (1080, 1080))
+                if image.mode != 'RGB' :
+                    image = image.convert('RGB')
+                # single pass baseline 4:2:0, instagram recompresses anyway
+                image.save(dst, 'JPEG', quality=85, subsampling=2, progressive=False, optimize=False)
+
+        if passthrough :
+            os.replace(src, dst)
+
+    async def probe(self, path) :
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+        if process.returncode != 0 :
+            return {}
+
+        return orjson.loads(stdout)
+
+    async def convert_video(self, src, dst) :
+        info = await self.probe(src)
+        video_stream = next((stream for stream in info.get('streams', []) if stream.get('codec_type') == 'video'), {})
+        video = video_stream.get('codec_name')
+        # instagram wants 8-bit 4:2:0, 10-bit / 4:4:4 h264 still has to be re-encoded
+        yuv420p = video_stream.get('pix_fmt') == 'yuv420p'
+        audio = next((stream.get('codec_name') for stream in info.get('streams', []) if stream.get('codec_type') == 'audio'), 'aac')
+        container = info.get('format', {})
+
+        # quicktime and mp4 share a format_name, tell them apart by brand
+        if video == 'h264' and yuv420p and audio == 'aac' and 'mp4' in container.get('format_name', '') and container.get('tags', {}).get('major_brand', '').strip() != 'qt' :
+            # already an h264/aac mp4, nothing for ffmpeg to do
+            os.replace(src, dst)
+            return
 
+        if video == 'h264' and yuv420p :
+            # already h264, remux into mp4 without re-encoding the video. instagram wants aac audio
+            args = ['-c:v', 'copy', '-c:a', 'copy' if audio == 'aac' else 'aac', '-movflags', '+faststart']
+            if await self.run_ffmpeg([], src, args, dst) == 0 :
+                return
+            # e.g. a broken stream ffmpeg can't copy, re-encode instead
+            logging.info("[instagram] remux of %s failed, fall back to transcode", src)
+
+        if self.hwaccel == 'auto' :
+            async with self.hwaccel_lock :
+                if self.hwaccel == 'auto' :
+                    self.hwaccel = await self.detect_hwaccel()
+
+        if self.hwaccel in HWAccelConfig :
+            input_args, encoder = HWAccelConfig[self.hwaccel]
+            args = ['-c:v', encoder, '-b:v', '1.5M', '-c:a', 'aac', '-movflags', '+faststart']
+            if await self.run_ffmpeg(input_args, src, args, dst, self.hwaccel_sem) == 0 :
+                return
+            # e.g. an input the gpu can't decode or no free encoder session, the item is already popped so don't drop it
+            logging.info("[instagram] %s encode of %s failed, fall back to libx264", self.hwaccel, src)
+
+        args = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-threads', '2', '-movflags', '+faststart']
+        returncode = await self.run_ffmpeg([], src, args, dst)
+        if returncode != 0 :
+            raise RuntimeError(f"[instagram] ffmpeg exited with code {returncode}")
+
+    async def detect_hwaccel(self) :
+        # an encoder listed by `ffmpeg -encoders` may still lack the hardware, try a one frame encode instead
+        for name in HWAccelAutoOrder :
+            _, encoder = HWAccelConfig[name]
+            async with self.transcode_sem :
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-hide_banner', '-loglevel', 'quiet', '-f', 'lavfi', '-i', 'color=size=256x256', '-frames:v', '1', '-c:v', encoder, '-f', 'null', '-',
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+                )
+                returncode = await process.wait()
+            if returncode == 0 :
+                logging.info(f"[instagram] hwaccel auto detected {name}")
+                return name
+
+        logging.info("[instagram] no hwaccel encoder available, use libx264")
+        return ''
+
+    async def run_ffmpeg(self, input_args, src, args, dst, sem = None) :
+        async with sem or self.transcode_sem :
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', *input_args, '-i', src, *args, dst,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+            )
+            try :
+                return await process.wait()
+            except asyncio.CancelledError :
+                # cancelled with its item, don't leave ffmpeg writing into a folder that is about to be removed
+                process.kill()
+                await process.wait()
+                raise
+
+    async def download(self, url, path) :
+        async with self.session.get(url) as response :
+            response.raise_for_status()
+            with open(path, "wb") as f :
+                async for chunk in response.content.iter_chunked(1<<20) :
+                    f.write(chunk)
+
+    def remove_media(self, path) :
+        # item folders are flat, unlink the files directly instead of a full rmtree walk
+        try :
+            with os.scandir(path) as entries :
+                for entry in entries :
+                    os.unlink(entry.path)
+            os.rmdir(path)
+        except FileNotFoundError :
+            pass
+        except OSError as e :
+            logging.error(f"[instagram] failed to remove {path}. {e}")
+
+    async def process_media(self, media, id, idx) :
+        type = media['validate']['type']
+        filename_temp = f"_queue/media/{id}/_temp_{idx}_{id}_{media['filename']}"
+        async with self.media_sem :
+            try :
+                if type == 'PHOTO':
+                    filename = f"_queue/media/{id}/{idx}_{id}.jpg"
+                    await self.download(media['url'], filename_temp)
+                    await asyncio.to_thread(self.convert_photo, filename_temp, filename)
+                    return filename
+                elif type == 'VIDEO' :
+                    filename = f"_queue/media/{id}/{idx}_{id}.mp4"
+                    await self.download(media['url'], filename_temp)
+                    await self.convert_video(filename_temp, filename)
+                    return filename
+            finally :
+                Path(filename_temp).unlink(missing_ok=True)
+
+    async def upload_queue(self, queue) :
         proceed = False
 
         paths = []
         type = ''
         id = ''
 
-        if (queue.length() > 0) :
-            q = queue.get_first(True)
+        q = queue.get_first(True)
+        if q is not None :
             id = q['id']
             medias = q['attachments']
-            idx = 0
-            os.makedirs(f'_queue/media/{id}')
-            for media in medias :
-                type = media['validate']['type']
-                if media['validate']['type'] == 'PHOTO':
-                    idx += 1
-                    filename = f"_queue/media/{id}/{idx}_{q['id']}.jpg"
-                    media_response = requests.get(media['url'])
-                    Image.open(BytesIO(media_response.content)).convert('RGB').save(filename)
-                    paths.append(filename)
-                elif media['validate']['type'] == 'VIDEO' :
-                    idx += 1
-                    filename = f"_queue/media/{id}/{idx}_{q['id']}.mp4"
-                    filename_temp = f"_queue/media/{id}/_temp_{idx}_{q['id']}_{media['filename']}"
-                    media_response = requests.get(media['url'])
-                    with open(filename_temp, "wb") as f :
-                        f.write(media_response.content)
-
-                    ffmpeg.input(filename_temp).output(filename, loglevel="quiet").run(overwrite_output=True)
-
-                    paths.append(filename)
-                    
-            proceed = True
-
-            
-        if proceed :
-            print('[instagram] process queue')
-            if (len(paths) > 1) : 
-                response = self.client.album_upload(paths, cfg_instagram['caption'])
-            elif (len(paths) == 1) :
-                if type == 'PHOTO' :
-                    response = self.client.photo_upload(paths[0], cfg_instagram['caption'])
-                elif type == 'VIDEO' :
-                    response = self.client.video_upload(paths[0], cfg_instagram['caption'])
-            print('[instagram] process queue finished')
-
-            shutil.rmtree(f'_queue/media/{id}', ignore_errors=True)
+            await asyncio.to_thread(os.makedirs, f'_queue/media/{id}')
+            # the item is already popped, its folder goes away whether or not the upload made it
+            try :
+                # a failed attachment cancels its siblings instead of leaving them converting into a dead item
+                async with asyncio.TaskGroup() as group :
+                    jobs = [group.create_task(self.process_media(media, id, idx)) for idx, media in enumerate(medias, 1)]
+                paths = [path for path in (job.result() for job in jobs) if path]
+                type = medias[-1]['validate']['type']
+                proceed = True
+
+                logging.info("[instagram] process queue")
+                # instagrapi is blocking and not safe for concurrent use, one upload at a time in a worker thread
+                async with self.upload_lock :
+                    if (len(paths) > 1) : 
+                        response = await asyncio.to_thread(self.client.album_upload, paths, cfg_instagram['caption'])
+                    elif (len(paths) == 1) :
+                        if type == 'PHOTO' :
+                            response = await asyncio.to_thread(self.client.photo_upload, paths[0], cfg_instagram['caption'])
+                        elif type == 'VIDEO' :
+                            response = await asyncio.to_thread(self.client.video_upload, paths[0], cfg_instagram['caption'])
+                logging.info("[instagram] process queue finished")
+            finally :
+                await asyncio.to_thread(self.remove_media, f'_queue/media/{id}')
 
         return {
             "id" : id,
@@ -156,21 +397,56 @@ class InstagramClient(IGClient) :
 #     logging.info("Hello world")
 
 class DiscordClient(discord.Client):
+    def __init__(self, *args, **kwargs) :
+        super().__init__(*args, **kwargs)
+        self.queue = QueueManager()
+        self.session = None
+        self.ig = None
+        self.submit_channel = None
+        self.queue_channel = None
+
+    async def setup_hook(self) :
+        # no total timeout, large videos may take a while; only a stalled connection is aborted
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30))
+        self.flush_queue.start()
+
+    async def close(self) :
+        # stop the loops and the gateway first, a late tick or event would append to an already closed list.log
+        self.upload_meme.cancel()
+        self.flush_queue.cancel()
+        await super().close()
+        self.queue.close()
+        if self.session :
+            await self.session.close()
+
+    @tasks.loop(seconds=1)
+    async def flush_queue(self) :
+        self.queue.flush()
+
+    # currently unused, both call sites are commented out. channel name edits are rate limited to 2 per 10 minutes,
+    # re-enable only behind a debounce
     # @tasks.loop(seconds=10)
     async def update_queue(self) :
-        queue_channel = self.get_channel(cfg_discord['queue_channel_id'])
-        await queue_channel.edit(name=f"Queue : {QueueManager().length()}")
+        await self.queue_channel.edit(name=f"Queue : {self.queue.length()}")
 
     @tasks.loop(seconds=5)
     async def upload_meme(self) :
-        ig = InstagramClient()
-        result = ig.upload_queue()
+        if self.queue.length() == 0 :
+            # idle, back off 5s -> 10s -> ... -> 60s instead of waking every 5s
+            self.upload_meme.change_interval(seconds=min(self.upload_meme.seconds * 2, 60))
+            return
+
+        self.upload_meme.change_interval(seconds=5)
+        if self.ig is None :
+            # login / session load is blocking, keep it off the event loop
+            self.ig = await asyncio.to_thread(InstagramClient, self.session)
+        result = await self.ig.upload_queue(self.queue)
 
         if result['status'] :
-            submit_channel = self.get_channel(cfg_discord['submit_channel_id'])
-            message = await submit_channel.fetch_message(result['id'])
+            # reactions only need the id, skip the fetch round trip
+            message = self.submit_channel.get_partial_message(result['id'])
             await message.clear_reactions()
-            await message.add_reaction('✅')
+            await message.add_reaction(ReactionConfig['uploaded'])
 
             # await self.update_queue()
 
@@ -181,28 +457,27 @@ class DiscordClient(discord.Client):
     async def on_ready(self):
         logging.info("[discord] bot ready")
         print(f'Logged on as {self.user}!')
+        # client.get_channel walks every guild, resolve through the one guild we serve
+        guild = self.get_guild(GUILD_ID)
+        self.submit_channel = guild.get_channel(SUBMIT_CHANNEL_ID)
+        self.queue_channel = guild.get_channel(QUEUE_CHANNEL_ID)
         self.upload_meme.start()
         # self.update_queue.start()
         
     async def on_message(self, message):
-        if message.author.bot :
+        # most selective check first, nearly all traffic is outside the submit channel
+        if message.channel.id != SUBMIT_CHANNEL_ID:
             return
         
-        if message.author.id == self.user.id :
+        if message.guild.id != GUILD_ID:
             return
         
-        if message.guild.id != cfg_discord['guild_id']:
+        if message.author.bot :
             return
         
-        if message.channel.id != cfg_discord['submit_channel_id']:
+        if message.author.id == self.user.id :
             return
         
-        log_channel = self.get_channel(cfg_discord['log_channel_id'])
-        
-        logging.info("[discord] retrieve new submission")
-
-        # await log_channel.send(content="Hello")
-        
         # print (message.author.bot)
         # print(f'Message from {message.author}: {message.content}')
 
@@ -231,19 +506,26 @@ class DiscordClient(discord.Client):
                     "date" : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 }
 
-                QueueManager().add(media)
+                self.queue.add(media)
 
-            await message.add_reaction('🕒' if isvalid else '❌')
+            logging.info("[discord] retrieve new submission %s. attachments = %s, valid = %s", message.id, len(attachments), isvalid)
+            await message.add_reaction(ReactionConfig['queued'] if isvalid else ReactionConfig['invalid'])
         else :
+            logging.info("[discord] submission %s has no attachment. delete", message.id)
             await message.delete()
 
         #proceed
        
     
     async def on_raw_message_delete(self, message):
-        QueueManager().remove_by_id(message)
+        if message.channel_id != SUBMIT_CHANNEL_ID:
+            return
+
+        self.queue.remove_by_id(message)
 
 def main() :
+    setup_logging()
+
     intents = discord.Intents.default()
     intents.message_content = True
 
@@ -1,9 +1,18 @@
-import json
+import orjson
+from pathlib import Path
 
 class Config :
+    # parsed config.json, shared by every Config instance
+    cache = None
+
     def __init__(self):
-        self.path = 'config.json'
+        self.path = Path('config.json')
 
     def load(self) :
-        with open(self.path) as f :
-            return json.load(f)
+        if Config.cache is None :
+            return self.reload()
+        return Config.cache
+
+    def reload(self) :
+        Config.cache = orjson.loads(self.path.read_bytes())
+        return Config.cache